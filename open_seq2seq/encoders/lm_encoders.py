@@ -5,15 +5,43 @@ RNN-based encoders
 from __future__ import absolute_import, division, print_function
 from __future__ import unicode_literals
 
-import copy, inspect
+import copy, hashlib, inspect
 import tensorflow as tf
 from tensorflow.contrib.cudnn_rnn.python.ops import cudnn_rnn_ops
+from tensorflow.python.util import tf_inspect
 from open_seq2seq.optimizers.mp_wrapper import mp_regularizer_wrapper
 from open_seq2seq.parts.rnns.utils import single_cell
 from .encoder import Encoder
 # from open_seq2seq.parts.rnns.weight_drop import WeightDropLayerNormBasicLSTMCell
 
 
+def _salted_seed(seed, salt):
+  """Derives a separate dropout seed for every salt, the same way
+  DropoutWrapper does for its input, state and output dropout. Dropout ops
+  with equal seeds and shapes would otherwise draw identical masks."""
+  if seed is None:
+    return None
+  salted_seed = "%s_%s" % (seed, salt)
+  string_hash = hashlib.md5(salted_seed.encode("utf-8")).hexdigest()[:8]
+  return int(string_hash, 16) & 0x7FFFFFFF
+
+
+class _OutputProjection(tf.layers.Layer):
+  """Wraps a projection function into a layer, so that it can be used as
+  ``output_layer`` of ``tf.contrib.seq2seq.BasicDecoder``."""
+  def __init__(self, projection_fn, num_outputs, **kwargs):
+    super(_OutputProjection, self).__init__(**kwargs)
+    self._projection_fn = projection_fn
+    self._num_outputs = num_outputs
+
+  def call(self, inputs):
+    return self._projection_fn(inputs)
+
+  def compute_output_shape(self, input_shape):
+    input_shape = tf.TensorShape(input_shape)
+    return input_shape[:-1].concatenate(self._num_outputs)
+
+
 class LMEncoder(Encoder):
   """
   RNN-based encoder with embeddings for language modeling
@@ -61,6 +89,12 @@ class LMEncoder(Encoder):
       "num_sampled": int,
       "fc_dim": int,
       "use_cell_state": bool,
+      "precompute_input_projection": bool,
+      "use_fused_rnn": bool,
+      "use_xla_jit_rnn": bool,
+      "fc_num_shards": int,
+      "infer_unroll_steps": int,
+      "recompute_rnn_layers": bool,
     })
 
   def __init__(self, params, model,
@@ -91,7 +125,8 @@ class LMEncoder(Encoder):
                             when applying tanh for the input transform step
       * weight_variational: whether to keep the same weight dropout mask
                             at every timestep. This feature is not yet implemented.
-      * emb_keep_prob: keep probability for dropout of the embedding matrix
+      * emb_keep_prob: keep probability for dropout of the embeddings. Whole
+                       embedding vectors of the looked up tokens are dropped
       * encoder_dp_input_keep_prob: keep probability for dropout on input of a LSTM cell
                                     in the layer which is not the last layer
       * encoder_dp_output_keep_prob: keep probability for dropout on output of a LSTM cell
@@ -107,6 +142,62 @@ class LMEncoder(Encoder):
                         the last cell state to input into the last output layer.
                         This only works for the text classification task, not the
                         language modeling phase.
+      * use_cudnn_rnn: if set to True, train and eval run all layers as a
+                       single ``cudnn_rnn_type`` block (CudnnLSTM or
+                       CudnnGRU), and inference restores the weights into
+                       CudnnCompatibleLSTMCell/CudnnCompatibleGRUCell.
+                       Dropout between layers is folded into the block's
+                       single dropout rate, so it has to be the same between
+                       all layers. ``core_cell`` is ignored, as are
+                       recurrent and weight dropout. Sequence lengths are
+                       passed to the block starting from TF 1.14, older
+                       versions still run (and return the state after)
+                       the padded steps.
+      * precompute_input_projection: if set to True, the input kernel of the
+                                     first layer is applied to all timesteps
+                                     with a single matmul before the RNN loop.
+                                     Only supported for
+                                     WeightDropLayerNormBasicLSTMCell.
+                                     This changes the variables of the first
+                                     layer: its ``kernel`` is replaced by the
+                                     encoder-level ``InputProjectionKernel``
+                                     and a ``recurrent_kernel`` of the cell,
+                                     so checkpoints trained with and without
+                                     this option can't be restored into each
+                                     other.
+      * use_fused_rnn: if set to True, each layer is run as a single
+                       LSTMBlockFusedCell kernel over the whole sequence
+                       instead of stepping ``core_cell`` in a loop.
+                       This is the fastest LSTM on CPU. ``core_cell`` is
+                       ignored, as are recurrent and weight dropout.
+                       Skip connections and ``core_cell_params`` other
+                       than num_units and forget_bias are not supported
+                       and raise a ValueError.
+      * use_xla_jit_rnn: if set to True, ops of the ``core_cell`` RNN loop are
+                         compiled with XLA, which fuses the point-wise gate
+                         operations of each step into a few kernels. Unlike
+                         the model-level ``use_xla_jit``, the rest of the
+                         graph is left alone. Also applies together with
+                         ``recompute_rnn_layers``.
+      * fc_num_shards: number of shards the [last_output_dim, fc_dim] output
+                       kernel is split into along the classes axis. Logits
+                       are computed shard by shard and concatenated, which
+                       avoids concatenating the full kernel for large
+                       vocabularies. With sampled softmax or tied weights,
+                       the transposed shards are passed to the loss (and
+                       used for embedding lookups) as a list.
+      * infer_unroll_steps: (default: 1) if greater than 1, greedy generation
+                            in inference is done with a tf.while_loop that
+                            runs that many decoding steps per iteration,
+                            instead of ``dynamic_decode``.
+      * recompute_rnn_layers: if set to True, in training every ``core_cell``
+                              layer is run by its own ``dynamic_rnn`` wrapped
+                              in ``recompute_grad``. Only the outputs of each
+                              layer are kept for the backward pass, the
+                              activations inside the layer are recomputed.
+                              Use this instead of ``use_swap_memory``, and
+                              set ``dropout_seed`` so that recomputed dropout
+                              masks match the forward pass.
       For different ways to do dropout for LSTM cells, please read this article:
       https://medium.com/@bingobee01/a-review-of-dropout-as-applied-to-rnns-72e79ecd5b7b
 
@@ -139,6 +230,7 @@ class LMEncoder(Encoder):
     if mode == 'infer' and self._lm_phase:
       self._batch_size = len(self.params['seed_tokens'])
     self._use_cell_state = self.params.get('use_cell_state', False)
+    self._constants = {}
 
   def encode(self, input_dict):
     """Wrapper around :meth:`self._encode() <_encode>` method.
@@ -155,10 +247,10 @@ class LMEncoder(Encoder):
     if not self._compiled:
       if 'regularizer' not in self._params:
         if self._model and 'regularizer' in self._model.params:
-          self._params['regularizer'] = copy.deepcopy(
-              self._model.params['regularizer']
-          )
-          self._params['regularizer_params'] = copy.deepcopy(
+          # the regularizer is a factory that is only called below, so it can
+          # be shared with the model; its params only need a shallow copy
+          self._params['regularizer'] = self._model.params['regularizer']
+          self._params['regularizer_params'] = dict(
               self._model.params['regularizer_params']
           )
 
@@ -196,11 +288,37 @@ class LMEncoder(Encoder):
     time_major = self.params.get("time_major", False)
     use_swap_memory = self.params.get("use_swap_memory", False)
 
+    # reading the parameters used while building every layer only once
+    dtype = self._params['dtype']
+    num_layers = self.params['encoder_layers']
+    core_cell = self.params['core_cell']
+    core_cell_params = self.params['core_cell_params']
+    use_skip_connections = self.params['encoder_use_skip_connections']
+    weight_variational = self.params['weight_variational']
+    awd_initializer = self.params['awd_initializer']
+    dropout_seed = self.params['dropout_seed']
+
     regularizer = self.params.get('regularizer', None)
     fc_use_bias = self.params.get('fc_use_bias', True)
 
     use_cudnn_rnn = self.params.get("use_cudnn_rnn", False)
     cudnn_rnn_type = self.params.get("cudnn_rnn_type", None)
+    precompute_input_projection = self.params.get(
+      "precompute_input_projection", False)
+    project_inputs = lambda x: x
+    projected_input_keep_prob = 1.0
+
+    use_fused_rnn = self.params.get("use_fused_rnn", False)
+
+    if use_cudnn_rnn and precompute_input_projection:
+      raise ValueError(
+        "precompute_input_projection can't be used together with use_cudnn_rnn"
+      )
+    if use_fused_rnn and (use_cudnn_rnn or precompute_input_projection):
+      raise ValueError(
+        "use_fused_rnn can't be used together with use_cudnn_rnn "
+        "or precompute_input_projection"
+      )
 
     if 'initializer' in self.params:
       init_dict = self.params.get('initializer_params', {})
@@ -225,19 +343,11 @@ class LMEncoder(Encoder):
       input_weight_keep_prob, recurrent_weight_keep_prob = 1.0, 1.0
 
 
-    self._output_layer = tf.layers.Dense(
-      self._fc_dim, 
-      kernel_regularizer=regularizer,
-      kernel_initializer=initializer,
-      use_bias=fc_use_bias,
-      dtype=self._params['dtype']
-    )
-
     if self._weight_tied:
-      last_cell_params = copy.deepcopy(self.params['core_cell_params'])
+      last_cell_params = copy.deepcopy(core_cell_params)
       last_cell_params['num_units'] = self._emb_size
     else:
-      last_cell_params = self.params['core_cell_params']
+      last_cell_params = core_cell_params
     
     last_output_dim = last_cell_params['num_units']
 
@@ -245,23 +355,70 @@ class LMEncoder(Encoder):
       last_output_dim = 2 * last_output_dim
 
 
-    fake_input = tf.zeros(shape=(1, last_output_dim), 
-                          dtype=self._params['dtype'])
-    fake_output = self._output_layer.apply(fake_input)
-    with tf.variable_scope("dense", reuse=True):
-      dense_weights = tf.get_variable("kernel")
-      dense_biases = tf.get_variable("bias")
-    
-    if self._weight_tied and self._lm_phase:
-      enc_emb_w = tf.transpose(dense_weights)
+    fc_num_shards = self.params.get('fc_num_shards', 1)
+    use_sampled_softmax = (self._mode == 'train' and
+                           self._num_sampled < self._fc_dim)
+
+    # output layer variables (named as the ones of tf.layers.Dense). Only the
+    # kernel is split into shards (along the classes axis), the bias is not
+    with tf.variable_scope('dense'):
+      dense_weights = tf.get_variable(
+        name='kernel',
+        shape=[last_output_dim, self._fc_dim],
+        dtype=dtype,
+        initializer=initializer,
+        regularizer=regularizer,
+        partitioner=(tf.fixed_size_partitioner(fc_num_shards, axis=1)
+                     if fc_num_shards > 1 else None),
+      )
+      if fc_use_bias:
+        dense_biases = tf.get_variable(
+          name='bias',
+          shape=[self._fc_dim],
+          dtype=dtype,
+          initializer=tf.zeros_initializer(),
+        )
+      else:
+        dense_biases = None
+    if fc_num_shards > 1:
+      kernel_shards = list(dense_weights)
     else:
-      enc_emb_w = tf.get_variable(
-        name="EncoderEmbeddingMatrix",
-        shape=[self._vocab_size, self._emb_size],
-        dtype=self._params['dtype']
+      kernel_shards = [dense_weights]
+
+    def project_outputs(outputs):
+      # shard by shard, so that the partitioned kernel is never concatenated
+      logits = tf.concat(
+        [tf.tensordot(outputs, shard, axes=1) for shard in kernel_shards],
+        axis=-1,
       )
+      if dense_biases is not None:
+        logits = tf.nn.bias_add(logits, dense_biases)
+      return logits
+
+    if (self._weight_tied and self._lm_phase) or use_sampled_softmax:
+      # [fc_dim, last_output_dim] layout used by the tied embedding lookup
+      # and sampled softmax. Shards are transposed one by one and passed on
+      # as a list ("div" partitioned), so they are never concatenated
+      transposed_weights = [tf.cast(tf.transpose(shard), dtype)
+                            for shard in kernel_shards]
+      if fc_num_shards == 1:
+        transposed_weights = transposed_weights[0]
 
-    self._enc_emb_w = tf.nn.dropout(enc_emb_w, keep_prob=emb_keep_prob)
+    if self._weight_tied and self._lm_phase:
+      # converted once here rather than in every call of _embed(), which is
+      # once per step in inference
+      self._enc_emb_w = transposed_weights
+    else:
+      # cast once here so that lookups (including the per-step ones
+      # in inference) don't need to cast their results
+      self._enc_emb_w = tf.cast(
+        tf.get_variable(
+          name="EncoderEmbeddingMatrix",
+          shape=[self._vocab_size, self._emb_size],
+          dtype=dtype
+        ),
+        dtype,
+      )
 
     if use_cudnn_rnn:
       if self._mode == 'train' or self._mode == 'eval':
@@ -273,10 +430,32 @@ class LMEncoder(Encoder):
         if not cudnn_rnn_type in all_cudnn_classes:
           raise TypeError("rnn_type must be a Cudnn RNN class")
 
+        # cuDNN applies a single dropout between layers, so the output
+        # dropout of a layer and the input dropout of the next one are folded
+        # into it. Input dropout of the first layer and output dropout of the
+        # last one are done explicitly before and after the block is called
+        first_input_keep_prob = (last_input_keep_prob if num_layers == 1
+                                 else dp_input_keep_prob)
+        between_keep_probs = set(
+          dp_output_keep_prob * (last_input_keep_prob if i == num_layers - 2
+                                 else dp_input_keep_prob)
+          for i in range(num_layers - 1)
+        )
+        if len(between_keep_probs) > 1:
+          raise ValueError(
+            "use_cudnn_rnn requires the same dropout between all layers, "
+            "use encoder_last_input_keep_prob equal to "
+            "encoder_dp_input_keep_prob"
+          )
+        between_keep_prob = between_keep_probs.pop() if num_layers > 1 else 1.0
         rnn_block = cudnn_rnn_type(
-            num_layers=self.params['encoder_layers'],
-            num_units=self._emb_size, 
-            dtype=self._params['dtype'],
+            num_layers=num_layers,
+            num_units=self._emb_size,
+            input_mode=cudnn_rnn_ops.CUDNN_INPUT_LINEAR_MODE,
+            direction=cudnn_rnn_ops.CUDNN_RNN_UNIDIRECTION,
+            dropout=1.0 - between_keep_prob,
+            seed=dropout_seed,
+            dtype=dtype,
             name="cudnn_rnn"
         )
       else:
@@ -287,77 +466,253 @@ class LMEncoder(Encoder):
         elif 'CudnnGRU' in str(cudnn_rnn_type):
           cell = lambda: tf.contrib.cudnn_rnn.CudnnCompatibleGRUCell(num_units=self._emb_size)
 
-        fwd_cells = [cell() for _ in range(self.params['encoder_layers'])]
+        fwd_cells = [cell() for _ in range(num_layers)]
         self._encoder_cell_fw = tf.nn.rnn_cell.MultiRNNCell(fwd_cells)
+    elif use_fused_rnn:
+      if use_skip_connections:
+        raise ValueError(
+          "use_fused_rnn can't be used together with "
+          "encoder_use_skip_connections"
+        )
+      unsupported_params = sorted(
+        set(core_cell_params) - {'num_units', 'forget_bias'}
+      )
+      if unsupported_params:
+        raise ValueError(
+          "use_fused_rnn only supports num_units and forget_bias in "
+          "core_cell_params, got: {}".format(", ".join(unsupported_params))
+        )
+      forget_bias = core_cell_params.get('forget_bias', 1.0)
+      layer_units = [core_cell_params['num_units']] * (num_layers - 1) + [
+        last_cell_params['num_units']
+      ]
+      # LSTMBlockCell has the same variables as LSTMBlockFusedCell, so it is
+      # used to restore the fused weights for step-by-step generation
+      self._encoder_cell_fw = tf.nn.rnn_cell.MultiRNNCell([
+        tf.contrib.rnn.LSTMBlockCell(
+          num_units,
+          forget_bias=forget_bias,
+          dtype=dtype,
+        ) for num_units in layer_units
+      ])
     else:
-      fwd_cells = [
-        single_cell(cell_class=self.params['core_cell'],
-                    cell_params=self.params['core_cell_params'],
-                    dp_input_keep_prob=dp_input_keep_prob,
-                    dp_output_keep_prob=dp_output_keep_prob,
-                    recurrent_keep_prob=recurrent_keep_prob,
-                    input_weight_keep_prob=input_weight_keep_prob,
-                    recurrent_weight_keep_prob=recurrent_weight_keep_prob,
-                    weight_variational=self.params['weight_variational'],
-                    dropout_seed=self.params['dropout_seed'],
-                    residual_connections=self.params['encoder_use_skip_connections'],
-                    awd_initializer=self.params['awd_initializer'],
-                    dtype=self._params['dtype']
-                    ) for _ in range(self.params['encoder_layers'] - 1)]
-
-      fwd_cells.append(
-        single_cell(cell_class=self.params['core_cell'],
-                    cell_params=last_cell_params,
-                    dp_input_keep_prob=last_input_keep_prob,
-                    dp_output_keep_prob=last_output_keep_prob,
-                    recurrent_keep_prob=recurrent_keep_prob,
-                    input_weight_keep_prob=input_weight_keep_prob,
-                    recurrent_weight_keep_prob=recurrent_weight_keep_prob,
-                    weight_variational=self.params['weight_variational'],
-                    dropout_seed=self.params['dropout_seed'],
-                    residual_connections=self.params['encoder_use_skip_connections'],
-                    awd_initializer=self.params['awd_initializer'],
-                    dtype=self._params['dtype']
-                    )
+      if precompute_input_projection:
+        if 'WeightDropLayerNormBasicLSTMCell' not in str(core_cell):
+          raise ValueError(
+            "precompute_input_projection is only supported for "
+            "WeightDropLayerNormBasicLSTMCell"
+          )
+        if use_skip_connections:
+          raise ValueError(
+            "precompute_input_projection can't be used together with "
+            "encoder_use_skip_connections"
+          )
+        # The first layer's input GEMM does not depend on the recurrence, so
+        # it is done for all timesteps at once, outside of the RNN loop.
+        # Input weight dropout is applied once per batch to this kernel.
+        first_num_units = (last_cell_params if num_layers == 1
+                           else core_cell_params)['num_units']
+        input_kernel = tf.get_variable(
+          name="InputProjectionKernel",
+          shape=[self._emb_size, 4 * first_num_units],
+          dtype=dtype,
+        )
+        if input_weight_keep_prob < 1.0:
+          input_kernel = tf.nn.dropout(
+            input_kernel,
+            keep_prob=input_weight_keep_prob,
+            seed=_salted_seed(dropout_seed, 'input_projection_kernel'),
+          )
+        project_inputs = lambda x: tf.tensordot(x, input_kernel, axes=1)
+        # input dropout of the first layer has to be applied to the
+        # embeddings, before they are projected
+        projected_input_keep_prob = (last_input_keep_prob if num_layers == 1
+                                     else dp_input_keep_prob)
+
+      fwd_cells = []
+      for i in range(num_layers):
+        is_last = i == num_layers - 1
+        cell_params = (last_cell_params if is_last
+                       else core_cell_params)
+        layer_input_keep_prob = (last_input_keep_prob if is_last
+                                 else dp_input_keep_prob)
+        layer_input_weight_keep_prob = input_weight_keep_prob
+        if i == 0 and precompute_input_projection:
+          cell_params = dict(cell_params, input_projected=True)
+          layer_input_keep_prob = 1.0
+          layer_input_weight_keep_prob = 1.0
+
+        fwd_cells.append(
+          single_cell(cell_class=core_cell,
+                      cell_params=cell_params,
+                      dp_input_keep_prob=layer_input_keep_prob,
+                      dp_output_keep_prob=(last_output_keep_prob if is_last
+                                           else dp_output_keep_prob),
+                      recurrent_keep_prob=recurrent_keep_prob,
+                      input_weight_keep_prob=layer_input_weight_keep_prob,
+                      recurrent_weight_keep_prob=recurrent_weight_keep_prob,
+                      weight_variational=weight_variational,
+                      dropout_seed=dropout_seed,
+                      residual_connections=use_skip_connections,
+                      awd_initializer=awd_initializer,
+                      dtype=dtype
+                      )
         )
 
       self._encoder_cell_fw = tf.contrib.rnn.MultiRNNCell(fwd_cells)
 
-    time_major = self.params.get("time_major", False)
-    use_swap_memory = self.params.get("use_swap_memory", False)
-
     source_sequence = input_dict['source_tensors'][0]
     source_length = input_dict['source_tensors'][1]
 
     # Inference for language modeling requires a different graph
     if (not self._lm_phase) or self._mode == 'train' or self._mode == 'eval':
-      embedded_inputs = tf.cast(tf.nn.embedding_lookup(
-        self.enc_emb_w,
-        source_sequence,
-      ), self.params['dtype'])
+      # All RNN implementations below are run time-major, which is their
+      # natural layout. Transposing the token ids ([B, T] --> [T, B]) is much
+      # cheaper than transposing the embedded inputs.
+      if time_major == False:
+        source_sequence = tf.transpose(source_sequence, [1, 0])
+
+      embedded_inputs = self._embed(source_sequence)
+      if emb_keep_prob < 1.0:
+        # dropping whole looked up embeddings instead of applying dropout
+        # to the full [vocab_size, emb_size] matrix
+        embedded_inputs = tf.nn.dropout(
+          embedded_inputs,
+          keep_prob=emb_keep_prob,
+          noise_shape=tf.concat([tf.shape(source_sequence), [1]], axis=0),
+          seed=_salted_seed(dropout_seed, 'embedding'),
+        )
+      if projected_input_keep_prob < 1.0:
+        embedded_inputs = tf.nn.dropout(
+          embedded_inputs,
+          keep_prob=projected_input_keep_prob,
+          seed=_salted_seed(dropout_seed, 'projected_input'),
+        )
+      embedded_inputs = project_inputs(embedded_inputs)
 
       if use_cudnn_rnn:
+        if first_input_keep_prob < 1.0:
+          embedded_inputs = tf.nn.dropout(
+            embedded_inputs,
+            keep_prob=first_input_keep_prob,
+            seed=_salted_seed(dropout_seed, 'input_0'),
+          )
         # The CudnnLSTM will return encoder_state as a tuple of hidden 
         # and cell values that. The hidden and cell tensors are stored for
         # each LSTM Layer.
+        rnn_block.build(embedded_inputs.get_shape())
+        # with sequence_lengths, cuDNN masks the steps past the end of each
+        # sequence itself and returns the state at the last valid step.
+        # Cudnn RNN layers only accept sequence_lengths starting from TF 1.14
+        if 'sequence_lengths' in tf_inspect.getargspec(rnn_block.call).args:
+          encoder_outputs, encoder_state = rnn_block(
+            embedded_inputs,
+            sequence_lengths=source_length,
+            time_major=True,
+            training=self._mode == 'train',
+          )
+        else:
+          encoder_outputs, encoder_state = rnn_block(
+            embedded_inputs,
+            training=self._mode == 'train',
+          )
+        if last_output_keep_prob < 1.0:
+          encoder_outputs = tf.nn.dropout(
+            encoder_outputs,
+            keep_prob=last_output_keep_prob,
+            seed=_salted_seed(dropout_seed, 'output_{}'.format(num_layers - 1)),
+          )
+      elif use_fused_rnn:
+        encoder_outputs = embedded_inputs
+        encoder_state = []
+        for i, num_units in enumerate(layer_units):
+          if i == len(layer_units) - 1:
+            input_keep_prob = last_input_keep_prob
+            output_keep_prob = last_output_keep_prob
+          else:
+            input_keep_prob = dp_input_keep_prob
+            output_keep_prob = dp_output_keep_prob
+
+          # every dropout needs its own seed, otherwise the output dropout
+          # of one layer and the input dropout of the next one would draw
+          # the same mask
+          if input_keep_prob < 1.0:
+            encoder_outputs = tf.nn.dropout(
+              encoder_outputs,
+              keep_prob=input_keep_prob,
+              seed=_salted_seed(dropout_seed, 'input_{}'.format(i)),
+            )
+          fused_cell = tf.contrib.rnn.LSTMBlockFusedCell(
+            num_units,
+            forget_bias=forget_bias,
+            dtype=dtype,
+            name='lstm_cell',
+          )
+          # matches variable names of the MultiRNNCell used in inference
+          with tf.variable_scope('decoder/multi_rnn_cell/cell_{}'.format(i)):
+            encoder_outputs, layer_state = fused_cell(
+              encoder_outputs,
+              dtype=dtype,
+              sequence_length=source_length,
+            )
+          if output_keep_prob < 1.0:
+            encoder_outputs = tf.nn.dropout(
+              encoder_outputs,
+              keep_prob=output_keep_prob,
+              seed=_salted_seed(dropout_seed, 'output_{}'.format(i)),
+            )
+          encoder_state.append(layer_state)
+        encoder_state = tuple(encoder_state)
+      else:
+        if self._mode == 'train' and self.params.get('recompute_rnn_layers',
+                                                     False):
+          def run_rnn():
+            layer_outputs = embedded_inputs
+            layer_states = []
+            for i, cell in enumerate(fwd_cells):
+              def layer_fn(inputs, cell=cell, i=i):
+                # same variable names as for the MultiRNNCell used otherwise
+                outputs, state = tf.nn.dynamic_rnn(
+                  cell=cell,
+                  inputs=inputs,
+                  sequence_length=source_length,
+                  time_major=True,
+                  swap_memory=use_swap_memory,
+                  dtype=dtype,
+                  scope='decoder/multi_rnn_cell/cell_{}'.format(i),
+                )
+                return [outputs] + tf.contrib.framework.nest.flatten(state)
+
+              # recompute_grad only supports resource variables
+              with tf.variable_scope(tf.get_variable_scope(),
+                                     use_resource=True):
+                layer_results = tf.contrib.layers.recompute_grad(layer_fn)(
+                  layer_outputs,
+                )
+              layer_outputs = layer_results[0]
+              layer_states.append(tf.contrib.framework.nest.pack_sequence_as(
+                cell.state_size, layer_results[1:],
+              ))
+            return layer_outputs, tuple(layer_states)
+        else:
+          run_rnn = lambda: tf.nn.dynamic_rnn(
+            cell=self._encoder_cell_fw,
+            inputs=embedded_inputs,
+            sequence_length=source_length,
+            time_major=True,
+            swap_memory=use_swap_memory,
+            dtype=dtype,
+            scope='decoder',
+          )
 
-        # reshape to [B, T, C] --> [T, B, C]
-        if time_major == False:
-          embedded_inputs = tf.transpose(embedded_inputs, [1, 0, 2])
+        if self.params.get('use_xla_jit_rnn', False):
+          with tf.contrib.compiler.jit.experimental_jit_scope():
+            encoder_outputs, encoder_state = run_rnn()
+        else:
+          encoder_outputs, encoder_state = run_rnn()
 
-        rnn_block.build(embedded_inputs.get_shape())
-        encoder_outputs, encoder_state = rnn_block(embedded_inputs)
+      if self._lm_phase and time_major == False:
         encoder_outputs = tf.transpose(encoder_outputs, [1, 0, 2])
-      else:
-        encoder_outputs, encoder_state = tf.nn.dynamic_rnn(
-          cell=self._encoder_cell_fw,
-          inputs=embedded_inputs,
-          sequence_length=source_length,
-          time_major=time_major,
-          swap_memory=use_swap_memory,
-          dtype=self._params['dtype'],
-          scope='decoder',
-        )
 
       if not self._lm_phase:
         # CudnnLSTM stores cell and hidden state differently
@@ -372,24 +727,26 @@ class LMEncoder(Encoder):
           else:
             encoder_outputs = encoder_state[-1].h
 
-      if self._mode == 'train' and self._num_sampled < self._fc_dim: # sampled softmax
-        output_dict = {'weights': enc_emb_w,
+      if use_sampled_softmax:
+        # the projection is skipped here, the loss only computes logits for
+        # the sampled classes using the output layer parameters
+        # (weights are expected in [num_classes, dim] layout)
+        if dense_biases is None:
+          dense_biases = tf.zeros([self._fc_dim], dtype=dtype)
+        output_dict = {'weights': transposed_weights,
                     'bias': dense_biases,
                     'inputs': encoder_outputs,
                     'logits': encoder_outputs,
                     'outputs': [encoder_outputs],
                     'num_sampled': self._num_sampled}
       else: # full softmax
-        logits = self._output_layer.apply(encoder_outputs)
+        logits = project_outputs(encoder_outputs)
         output_dict = {'logits': logits, 'outputs': [logits]}
     else: # infer in LM phase
       # This portion of graph is required to restore weights from CudnnLSTM to 
       # CudnnCompatibleLSTMCell/CudnnCompatibleGRUCell
       if use_cudnn_rnn:
-        embedded_inputs = tf.cast(tf.nn.embedding_lookup(
-          self.enc_emb_w,
-          source_sequence,
-        ), self.params['dtype'])
+        embedded_inputs = self._embed(source_sequence)
 
         # Scope must remain unset to restore weights
         encoder_outputs, encoder_state = tf.nn.dynamic_rnn(
@@ -398,43 +755,166 @@ class LMEncoder(Encoder):
             sequence_length=source_length,
             time_major=time_major,
             swap_memory=use_swap_memory,
-            dtype=self._params['dtype']
+            dtype=dtype
         )
 
-      embedding_fn = lambda ids: tf.cast(tf.nn.embedding_lookup(
-                                          self.enc_emb_w,
-                                          ids,
-                                        ), self.params['dtype'])
-
-      helper = tf.contrib.seq2seq.GreedyEmbeddingHelper(
-        embedding=embedding_fn,#self._dec_emb_w,
-        start_tokens = tf.constant(self.params['seed_tokens']),
-        end_token=self.params['end_token'])
-      
-      decoder = tf.contrib.seq2seq.BasicDecoder(
-        cell=self._encoder_cell_fw,
-        helper=helper,
-        initial_state=self._encoder_cell_fw.zero_state(
-          batch_size=self._batch_size, dtype=self._params['dtype'],
-        ),
-        output_layer=self._output_layer,
-      )
-      maximum_iterations = tf.constant(self._num_tokens_gen)
-
-      final_outputs, final_state, final_sequence_lengths = tf.contrib.seq2seq.dynamic_decode(
-        decoder=decoder,
-        impute_finished=False,
-        maximum_iterations=maximum_iterations,
-        swap_memory=use_swap_memory,
-        output_time_major=time_major,
+      embedding_fn = lambda ids: project_inputs(self._embed(ids))
+
+      start_tokens = self._seed_tokens_const
+      initial_state = self._encoder_cell_fw.zero_state(
+        batch_size=self._batch_size, dtype=dtype,
       )
-      output_dict = {'logits': final_outputs.rnn_output,
-            'outputs': [tf.argmax(final_outputs.rnn_output, axis=-1)],
+      infer_unroll_steps = self.params.get('infer_unroll_steps', 1)
+
+      if infer_unroll_steps > 1:
+        logits, sample_ids, final_state, final_sequence_lengths = (
+          self._greedy_decode(
+            embedding_fn=embedding_fn,
+            projection_fn=project_outputs,
+            start_tokens=start_tokens,
+            initial_state=initial_state,
+            unroll_steps=infer_unroll_steps,
+            time_major=time_major,
+            swap_memory=use_swap_memory,
+          )
+        )
+      else:
+        helper = tf.contrib.seq2seq.GreedyEmbeddingHelper(
+          embedding=embedding_fn,#self._dec_emb_w,
+          start_tokens=start_tokens,
+          end_token=self.params['end_token'])
+
+        decoder = tf.contrib.seq2seq.BasicDecoder(
+          cell=self._encoder_cell_fw,
+          helper=helper,
+          initial_state=initial_state,
+          output_layer=_OutputProjection(project_outputs, self._fc_dim),
+        )
+        maximum_iterations = self._max_iters_const
+
+        final_outputs, final_state, final_sequence_lengths = tf.contrib.seq2seq.dynamic_decode(
+          decoder=decoder,
+          impute_finished=False,
+          maximum_iterations=maximum_iterations,
+          swap_memory=use_swap_memory,
+          output_time_major=time_major,
+        )
+        # GreedyEmbeddingHelper already took the (int32) argmax of the logits
+        # at every step, so there is no need to read all logits again
+        logits = final_outputs.rnn_output
+        sample_ids = final_outputs.sample_id
+
+      output_dict = {'logits': logits,
+            'outputs': [sample_ids],
             'final_state': final_state,
             'final_sequence_lengths': final_sequence_lengths}
 
     return output_dict
 
+  def _greedy_decode(self, embedding_fn, projection_fn, start_tokens,
+                     initial_state, unroll_steps, time_major, swap_memory):
+    """Greedy generation with ``unroll_steps`` decoding steps per iteration
+    of the while loop. Produces the same outputs as ``dynamic_decode`` with
+    ``GreedyEmbeddingHelper`` and ``impute_finished=False``. Steps of the
+    last iteration after the end of generation are still computed, but
+    their outputs are dropped and the state is not updated by them.
+
+    Args:
+      embedding_fn: function mapping token ids to cell inputs.
+      projection_fn: function mapping cell outputs to logits.
+      start_tokens: int Tensor of shape [batch_size] with the first tokens.
+      initial_state: initial state of ``self._encoder_cell_fw``.
+      unroll_steps (int): number of decoding steps per loop iteration.
+      time_major (bool): whether to return time-major outputs.
+      swap_memory (bool): passed to ``tf.while_loop``.
+
+    Returns:
+      tuple: logits, sample ids, final state and sequence lengths.
+    """
+    cell = self._encoder_cell_fw
+    end_token = self.params['end_token']
+    num_steps = self._num_tokens_gen
+    num_iterations = (num_steps + unroll_steps - 1) // unroll_steps
+
+    def condition(i, num_decoded, inputs, state, finished, lengths,
+                  logits_ta, ids_ta):
+      return tf.logical_and(i < num_iterations,
+                            tf.logical_not(tf.reduce_all(finished)))
+
+    def body(i, num_decoded, inputs, state, finished, lengths,
+             logits_ta, ids_ta):
+      for k in range(unroll_steps):
+        step = i * unroll_steps + k
+        # same stopping criteria as in dynamic_decode
+        active = tf.logical_and(step < num_steps,
+                                tf.logical_not(tf.reduce_all(finished)))
+        cell_outputs, next_state = cell(inputs, state)
+        state = tf.contrib.framework.nest.map_structure(
+          lambda new, old: tf.where(active, new, old), next_state, state,
+        )
+        logits = projection_fn(cell_outputs)
+        sample_ids = tf.argmax(logits, axis=-1, output_type=tf.int32)
+        lengths = tf.where(tf.logical_or(finished, tf.logical_not(active)),
+                           lengths, lengths + 1)
+        finished = tf.logical_or(finished, tf.equal(sample_ids, end_token))
+        num_decoded += tf.cast(active, tf.int32)
+        logits_ta = logits_ta.write(step, logits)
+        ids_ta = ids_ta.write(step, sample_ids)
+        inputs = embedding_fn(sample_ids)
+      return (i + 1, num_decoded, inputs, state, finished, lengths,
+              logits_ta, ids_ta)
+
+    batch_size = tf.shape(start_tokens)[0]
+    # same scope as used by dynamic_decode, so that variables are shared
+    with tf.variable_scope('decoder'):
+      loop_vars = (
+        tf.constant(0),
+        tf.constant(0),
+        embedding_fn(start_tokens),
+        initial_state,
+        tf.zeros([batch_size], dtype=tf.bool),
+        tf.zeros([batch_size], dtype=tf.int32),
+        tf.TensorArray(self._params['dtype'], size=0, dynamic_size=True),
+        tf.TensorArray(tf.int32, size=0, dynamic_size=True),
+      )
+      _, num_decoded, _, final_state, _, lengths, logits_ta, ids_ta = (
+        tf.while_loop(condition, body, loop_vars, swap_memory=swap_memory)
+      )
+
+    # the last iteration might have run past the end of generation
+    logits = logits_ta.stack()[:num_decoded]
+    sample_ids = ids_ta.stack()[:num_decoded]
+    if not time_major:
+      logits = tf.transpose(logits, [1, 0, 2])
+      sample_ids = tf.transpose(sample_ids, [1, 0])
+    return logits, sample_ids, final_state, lengths
+
+  def _embed(self, ids):
+    """Looks up embeddings of ``ids`` (of any shape) in ``self.enc_emb_w``.
+    With tied weights it is the transposed output kernel, which is a list of
+    shards if ``fc_num_shards`` > 1."""
+    return tf.nn.embedding_lookup(self._enc_emb_w, ids,
+                                  partition_strategy='div')
+
+  def _get_constant(self, name, value, dtype):
+    """Returns constant with the given value, creating it only once
+    per graph (``encode()`` might be called more than once)."""
+    const = self._constants.get(name)
+    if const is None or const.graph is not tf.get_default_graph():
+      const = tf.constant(value, dtype=dtype, name=name)
+      self._constants[name] = const
+    return const
+
+  @property
+  def _seed_tokens_const(self):
+    return self._get_constant('seed_tokens', self.params['seed_tokens'],
+                              tf.int32)
+
+  @property
+  def _max_iters_const(self):
+    return self._get_constant('max_iterations', self._num_tokens_gen,
+                              tf.int32)
+
   @property
   def vocab_size(self):
     return self._vocab_size
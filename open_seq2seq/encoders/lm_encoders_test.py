@@ -0,0 +1,316 @@
+# Copyright (c) 2018 NVIDIA Corporation
+from __future__ import absolute_import, division, print_function
+from __future__ import unicode_literals
+
+import numpy as np
+import tensorflow as tf
+
+from open_seq2seq.encoders import LMEncoder
+from open_seq2seq.losses import BasicSampledSequenceLoss
+from open_seq2seq.parts.rnns.weight_drop import WeightDropLayerNormBasicLSTMCell
+
+VOCAB_SIZE = 12
+BATCH_SIZE = 3
+TIME = 5
+
+
+def _lm_params(**kwargs):
+  params = {
+      'vocab_size': VOCAB_SIZE,
+      'emb_size': 8,
+      'encoder_layers': 2,
+      'encoder_use_skip_connections': False,
+      'core_cell': WeightDropLayerNormBasicLSTMCell,
+      'core_cell_params': {'num_units': 16},
+      'end_token': 1,
+      'batch_size': BATCH_SIZE,
+      'use_cudnn_rnn': False,
+      'cudnn_rnn_type': None,
+      'encoder_dp_input_keep_prob': 1.0,
+      'encoder_dp_output_keep_prob': 1.0,
+      'seed_tokens': [2, 3, 4],
+      'num_tokens_gen': 7,
+  }
+  params.update(kwargs)
+  return params
+
+
+def _source():
+  return np.random.RandomState(0).randint(
+      2, VOCAB_SIZE, size=[BATCH_SIZE, TIME],
+  )
+
+
+def _build_encoder(mode, params):
+  """Builds LMEncoder graph on random (but fixed) token ids."""
+  tf.set_random_seed(1234)
+  source = _source()
+  input_dict = {'source_tensors': [
+      tf.constant(source, dtype=tf.int32),
+      tf.constant([TIME, TIME - 1, TIME - 2], dtype=tf.int32),
+  ]}
+  encoder = LMEncoder(params, None, mode=mode)
+  return encoder, encoder.encode(input_dict)
+
+
+def _variable_names():
+  return sorted(var.name for var in tf.global_variables())
+
+
+def _get_variable(name):
+  for var in tf.global_variables():
+    if var.name == name + ':0':
+      return var
+  raise ValueError('No variable {}'.format(name))
+
+
+def _xla_compile_attrs(op_type):
+  """Returns ``_XlaCompile`` attr of all ``op_type`` ops inside RNN loops."""
+  attrs = []
+  for op in tf.get_default_graph().get_operations():
+    if op.type != op_type or '/while/' not in op.name:
+      continue
+    try:
+      attrs.append(op.get_attr('_XlaCompile'))
+    except ValueError:
+      attrs.append(None)
+  return attrs
+
+
+def _reads_variable(tensor):
+  """Whether tensor is a (possibly forwarded) variable value."""
+  op = tensor.op
+  while op.type in ['Identity', 'Enter', 'Cast', 'Transpose']:
+    op = op.inputs[0].op
+  return op.type in ['VariableV2', 'VarHandleOp', 'ReadVariableOp']
+
+
+def _variables_concatenated(loop_only=False):
+  """Returns concat ops (inside of while loops if ``loop_only`` is True)
+  that concatenate variables."""
+  return [
+      op.name for op in tf.get_default_graph().get_operations()
+      if op.type == 'ConcatV2' and (not loop_only or '/while/' in op.name) and
+      any(_reads_variable(inp) for inp in op.inputs[:-1])
+  ]
+
+
+class LMEncoderTest(tf.test.TestCase):
+
+  def test_fused_rnn_variables_match_inference(self):
+    names = {}
+    for mode in ['train', 'infer']:
+      with tf.Graph().as_default():
+        _build_encoder(mode, _lm_params(use_fused_rnn=True))
+        names[mode] = _variable_names()
+    self.assertIn(
+        'rnn_encoder_awd/decoder/multi_rnn_cell/cell_1/lstm_cell/kernel:0',
+        names['train'],
+    )
+    self.assertEqual(names['train'], names['infer'])
+
+  def test_cudnn_rnn_uneven_dropout(self):
+    params = _lm_params(
+        encoder_layers=3, use_cudnn_rnn=True,
+        cudnn_rnn_type=tf.contrib.cudnn_rnn.CudnnLSTM,
+        encoder_dp_input_keep_prob=1.0, encoder_last_input_keep_prob=0.5,
+    )
+    with tf.Graph().as_default():
+      with self.assertRaises(ValueError):
+        _build_encoder('train', params)
+
+  def test_fused_rnn_unsupported_params(self):
+    for params in [
+        _lm_params(use_fused_rnn=True, encoder_use_skip_connections=True),
+        _lm_params(use_fused_rnn=True,
+                   core_cell_params={'num_units': 16, 'layer_norm': True}),
+    ]:
+      with tf.Graph().as_default():
+        with self.assertRaises(ValueError):
+          _build_encoder('train', params)
+
+  def _generate(self, params, values=None):
+    """Runs generation, loading the given variable values (by name).
+    Returns sample ids, sequence lengths, final state and variable values."""
+    with tf.Graph().as_default() as graph:
+      _, output_dict = _build_encoder('infer', params)
+      variables = tf.global_variables()
+      with self.test_session(graph=graph) as sess:
+        sess.run(tf.global_variables_initializer())
+        if values is not None:
+          for var in variables:
+            var.load(values[var.name], sess)
+        ids, lengths, state = sess.run([
+            output_dict['outputs'][0],
+            output_dict['final_sequence_lengths'],
+            output_dict['final_state'],
+        ])
+        values = {var.name: var.eval(session=sess) for var in variables}
+    return ids, lengths, state, values
+
+  def _train_loss_and_grads(self, params, values=None):
+    """Computes training loss and gradients, loading the given variable
+    values (by name). Returns loss, gradients and variable values."""
+    with tf.Graph().as_default() as graph:
+      _, output_dict = _build_encoder('train', params)
+      # predicting the input tokens is enough to compare the graphs
+      loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(
+          labels=tf.constant(_source(), dtype=tf.int32),
+          logits=output_dict['logits'],
+      ))
+      variables = tf.trainable_variables()
+      grads = [tf.convert_to_tensor(grad)
+               for grad in tf.gradients(loss, variables)]
+      with self.test_session(graph=graph) as sess:
+        sess.run(tf.global_variables_initializer())
+        if values is not None:
+          for var in variables:
+            var.load(values[var.name], sess)
+        loss_value, grad_values = sess.run([loss, grads])
+        values = {var.name: var.eval(session=sess) for var in variables}
+    grad_values = {var.name: grad for var, grad in zip(variables, grad_values)}
+    return loss_value, grad_values, values
+
+  def test_recompute_rnn_layers(self):
+    loss, grads, values = self._train_loss_and_grads(_lm_params())
+    recomputed_loss, recomputed_grads, recomputed_values = (
+        self._train_loss_and_grads(_lm_params(recompute_rnn_layers=True),
+                                   values)
+    )
+    self.assertEqual(sorted(values), sorted(recomputed_values))
+    self.assertAllClose(loss, recomputed_loss)
+    for name in grads:
+      self.assertAllClose(grads[name], recomputed_grads[name], atol=1e-5)
+
+  def test_greedy_decode_matches_dynamic_decode(self):
+    for end_token in [1, 2, 5]:
+      ids, lengths, state, values = self._generate(_lm_params(
+          end_token=end_token,
+      ))
+      # num_tokens_gen is not divisible by infer_unroll_steps
+      unrolled_ids, unrolled_lengths, unrolled_state, _ = self._generate(
+          _lm_params(end_token=end_token, infer_unroll_steps=3), values,
+      )
+      self.assertAllEqual(ids, unrolled_ids)
+      self.assertAllEqual(lengths, unrolled_lengths)
+      for layer_state, unrolled_layer_state in zip(state, unrolled_state):
+        self.assertAllClose(layer_state.c, unrolled_layer_state.c)
+        self.assertAllClose(layer_state.h, unrolled_layer_state.h)
+
+  def test_sharded_output_layer_in_inference(self):
+    for weight_tied in [False, True]:
+      for unroll_steps in [1, 3]:
+        with tf.Graph().as_default():
+          _build_encoder('infer', _lm_params(
+              weight_tied=weight_tied, emb_size=16, fc_num_shards=2,
+              infer_unroll_steps=unroll_steps,
+          ))
+          self.assertEqual(_variables_concatenated(loop_only=True), [])
+
+  def test_sharded_output_layer_training(self):
+    for weight_tied in [False, True]:
+      for num_sampled in [VOCAB_SIZE, 4]:
+        with tf.Graph().as_default() as graph:
+          _, output_dict = _build_encoder('train', _lm_params(
+              weight_tied=weight_tied, emb_size=16, fc_num_shards=2,
+              num_sampled=num_sampled,
+          ))
+          targets = tf.constant(_source(), dtype=tf.int32)
+          if num_sampled < VOCAB_SIZE:
+            loss = BasicSampledSequenceLoss(
+                {'tgt_vocab_size': VOCAB_SIZE, 'batch_size': BATCH_SIZE},
+                None,
+            ).compute_loss({
+                'decoder_output': output_dict,
+                'target_tensors': [targets, tf.fill([BATCH_SIZE], TIME)],
+            })
+          else:
+            loss = tf.reduce_mean(
+                tf.nn.sparse_softmax_cross_entropy_with_logits(
+                    labels=targets, logits=output_dict['logits'],
+                )
+            )
+          train_op = tf.train.GradientDescentOptimizer(0.1).minimize(loss)
+
+          names = _variable_names()
+          self.assertIn('rnn_encoder_awd/dense/kernel/part_1:0', names)
+          self.assertIn('rnn_encoder_awd/dense/bias:0', names)
+          self.assertEqual(_variables_concatenated(), [])
+
+          with self.test_session(graph=graph) as sess:
+            sess.run(tf.global_variables_initializer())
+            for _ in range(2):
+              loss_value, _ = sess.run([loss, train_op])
+              self.assertTrue(np.isfinite(loss_value))
+
+  def test_tied_embedding_lookup(self):
+    ids_np = np.random.RandomState(1).randint(VOCAB_SIZE, size=[4, 2])
+    for fc_num_shards in [1, 2]:
+      with tf.Graph().as_default() as graph:
+        encoder, _ = _build_encoder('train', _lm_params(
+            weight_tied=True, emb_size=16, fc_num_shards=fc_num_shards,
+        ))
+        kernel_parts = tf.get_collection(
+            tf.GraphKeys.GLOBAL_VARIABLES, scope='rnn_encoder_awd/dense/kernel',
+        )
+        kernel = tf.concat(kernel_parts, axis=1)
+        checks = []
+        for ids in [tf.constant(ids_np[:, 0]), tf.constant(ids_np)]:
+          embedded = encoder._embed(ids)
+          expected = tf.gather(tf.transpose(kernel), ids)
+          # weighting the embeddings, so that gradients differ across columns
+          weights = tf.constant(np.random.RandomState(2).randn(
+              *expected.get_shape().as_list()
+          ), dtype=tf.float32)
+          checks.append((
+              (embedded, tf.gradients(tf.reduce_sum(embedded * weights),
+                                      kernel_parts)),
+              (expected, tf.gradients(tf.reduce_sum(expected * weights),
+                                      kernel_parts)),
+          ))
+        with self.test_session(graph=graph) as sess:
+          sess.run(tf.global_variables_initializer())
+          for (embedded, grads), (expected, expected_grads) in sess.run(
+              checks):
+            self.assertAllClose(embedded, expected)
+            for grad, expected_grad in zip(grads, expected_grads):
+              self.assertAllClose(grad, expected_grad)
+
+  def test_sampled_softmax_outputs(self):
+    for fc_use_bias in [True, False]:
+      with tf.Graph().as_default() as graph:
+        _, output_dict = _build_encoder('train', _lm_params(
+            num_sampled=4, fc_use_bias=fc_use_bias,
+        ))
+        self.assertEqual(output_dict['weights'].get_shape().as_list(),
+                         [VOCAB_SIZE, 16])
+        self.assertIsNotNone(output_dict['bias'])
+        kernel = _get_variable('rnn_encoder_awd/dense/kernel')
+        with self.test_session(graph=graph) as sess:
+          sess.run(tf.global_variables_initializer())
+          weights, bias, kernel = sess.run(
+              [output_dict['weights'], output_dict['bias'], kernel],
+          )
+        self.assertAllEqual(weights, kernel.T)
+        self.assertEqual(bias.shape, (VOCAB_SIZE,))
+        if not fc_use_bias:
+          self.assertAllEqual(bias, np.zeros(VOCAB_SIZE))
+
+  def test_xla_jit_rnn(self):
+    for recompute in [False, True]:
+      for use_xla in [False, True]:
+        with tf.Graph().as_default():
+          _build_encoder('train', _lm_params(
+              use_xla_jit_rnn=use_xla, recompute_rnn_layers=recompute,
+          ))
+          for op_type in ['Sigmoid', 'Tanh']:
+            attrs = _xla_compile_attrs(op_type)
+            self.assertTrue(attrs)
+            if use_xla:
+              self.assertTrue(all(attr is True for attr in attrs))
+            else:
+              self.assertTrue(all(attr is None for attr in attrs))
+
+
+if __name__ == '__main__':
+  tf.test.main()
@@ -384,7 +384,12 @@ class BasicSampledSequenceLoss(Loss):
       
       if inputs.dtype.base_dtype != tf.float32:
         inputs = tf.cast(inputs, tf.float32)
-      if weights.dtype.base_dtype != tf.float32:
+      # weights might be split into a list of shards along the classes axis
+      if isinstance(weights, (list, tuple)):
+        weights = [tf.cast(shard, tf.float32)
+                   if shard.dtype.base_dtype != tf.float32 else shard
+                   for shard in weights]
+      elif weights.dtype.base_dtype != tf.float32:
         weights = tf.cast(weights, tf.float32)
       if biases.dtype.base_dtype != tf.float32:
         biases = tf.cast(biases, tf.float32)
@@ -393,7 +398,8 @@ class BasicSampledSequenceLoss(Loss):
                                             targets, 
                                             inputs,
                                             input_dict['decoder_output']['num_sampled'],
-                                            self._tgt_vocab_size)
+                                            self._tgt_vocab_size,
+                                            partition_strategy='div')
 
 
       if self._average_across_timestep:
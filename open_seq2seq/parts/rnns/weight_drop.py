@@ -29,6 +29,7 @@ class WeightDropLayerNormBasicLSTMCell(tf.contrib.rnn.RNNCell):
                recurrent_weight_keep_prob=1.0,
                dropout_seed=None,
                weight_variational=False,
+               input_projected=False,
                reuse=None,
                dtype=None):
     """Initializes the basic LSTM cell.
@@ -50,6 +51,10 @@ class WeightDropLayerNormBasicLSTMCell(tf.contrib.rnn.RNNCell):
                            when applying tanh for the input transform step
       weight_variational: whether to keep the same weight dropout mask
                           at every timestep. This feature is not yet implemented.
+      input_projected: if True, inputs are expected to be already multiplied
+                       by the input kernel (shape [batch_size, 4 * num_units]),
+                       so only the recurrent kernel is applied at each step.
+                       Input weight dropout is then left to the caller.
       dropout_prob_seed: (optional) integer, the randomness seed.
       reuse: (optional) Python boolean describing whether to reuse variables
         in an existing scope.  If not `True`, and the existing scope already has
@@ -69,6 +74,7 @@ class WeightDropLayerNormBasicLSTMCell(tf.contrib.rnn.RNNCell):
     self._norm_shift = norm_shift
     self._reuse = reuse
     self._weight_variational = weight_variational
+    self._input_projected = input_projected
     self._dtype = dtype
 
     self._input_weight_noise = None
@@ -120,6 +126,21 @@ class WeightDropLayerNormBasicLSTMCell(tf.contrib.rnn.RNNCell):
       out = tf.nn.bias_add(out, bias)
     return out
 
+  def _recurrent_linear(self, h):
+    out_size = 4 * self._num_units
+    dtype = h.dtype
+    u = tf.get_variable("recurrent_kernel", [h.get_shape()[-1], out_size],
+                        dtype=dtype)
+
+    if self._should_drop(self._recurrent_weight_keep_prob):
+      u = self._dropout(u, self._recurrent_weight_noise, self._recurrent_weight_keep_prob)
+
+    out = tf.matmul(h, u)
+    if not self._layer_norm:
+      bias = tf.get_variable("bias", [out_size], dtype=dtype)
+      out = tf.nn.bias_add(out, bias)
+    return out
+
   def _variational_dropout(self, values, noise, keep_prob):
     '''
     TODO: Implement variational dropout for weight dropout
@@ -140,9 +161,12 @@ class WeightDropLayerNormBasicLSTMCell(tf.contrib.rnn.RNNCell):
   def call(self, inputs, state):
     """LSTM cell with layer normalization and recurrent dropout."""
     c, h = state
-    args = tf.concat([inputs, h], 1)
-    concat = self._linear(args, inputs.get_shape().as_list()[-1], h.get_shape().as_list()[-1])
-    dtype = args.dtype
+    dtype = inputs.dtype
+    if self._input_projected:
+      concat = inputs + self._recurrent_linear(h)
+    else:
+      args = tf.concat([inputs, h], 1)
+      concat = self._linear(args, inputs.get_shape().as_list()[-1], h.get_shape().as_list()[-1])
 
     i, j, f, o = tf.split(value=concat, num_or_size_splits=4, axis=1)
 
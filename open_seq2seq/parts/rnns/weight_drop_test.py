@@ -0,0 +1,72 @@
+# Copyright (c) 2018 NVIDIA Corporation
+from __future__ import absolute_import, division, print_function
+from __future__ import unicode_literals
+
+import numpy as np
+import tensorflow as tf
+
+from open_seq2seq.parts.rnns.weight_drop import WeightDropLayerNormBasicLSTMCell
+
+
+def _get_variable(scope, name):
+  for var in tf.get_collection(tf.GraphKeys.GLOBAL_VARIABLES, scope=scope):
+    if var.name.endswith('/{}:0'.format(name)):
+      return var
+  raise ValueError('No variable {} in scope {}'.format(name, scope))
+
+
+class WeightDropLayerNormBasicLSTMCellTest(tf.test.TestCase):
+
+  def _check_input_projected(self, layer_norm):
+    batch_size, time, input_size, num_units = 3, 5, 4, 6
+    np.random.seed(0)
+    inputs_np = np.random.randn(batch_size, time, input_size)
+
+    with tf.Graph().as_default() as graph:
+      inputs = tf.constant(inputs_np, dtype=tf.float32)
+
+      full_cell = WeightDropLayerNormBasicLSTMCell(num_units,
+                                                   layer_norm=layer_norm)
+      full_outputs, full_state = tf.nn.dynamic_rnn(
+          full_cell, inputs, dtype=tf.float32, scope='full',
+      )
+      kernel = _get_variable('full', 'kernel')
+      input_kernel, recurrent_kernel = tf.split(
+          kernel, [input_size, num_units], axis=0,
+      )
+
+      projected_cell = WeightDropLayerNormBasicLSTMCell(
+          num_units, layer_norm=layer_norm, input_projected=True,
+      )
+      projected_outputs, projected_state = tf.nn.dynamic_rnn(
+          projected_cell,
+          tf.tensordot(inputs, input_kernel, axes=1),
+          dtype=tf.float32,
+          scope='projected',
+      )
+
+      copy_ops = [tf.assign(_get_variable('projected', 'recurrent_kernel'),
+                            recurrent_kernel)]
+      if not layer_norm:
+        copy_ops.append(tf.assign(_get_variable('projected', 'bias'),
+                                  _get_variable('full', 'bias')))
+
+      with self.test_session(graph=graph) as sess:
+        sess.run(tf.global_variables_initializer())
+        sess.run(copy_ops)
+        full, projected = sess.run([(full_outputs, full_state),
+                                    (projected_outputs, projected_state)])
+
+    self.assertAllClose(full[0], projected[0], atol=1e-5)
+    self.assertAllClose(full[1].c, projected[1].c, atol=1e-5)
+    self.assertAllClose(full[1].h, projected[1].h, atol=1e-5)
+
+  def test_input_projected(self):
+    self._check_input_projected(layer_norm=False)
+
+  def test_input_projected_layer_norm(self):
+    self._check_input_projected(layer_norm=True)
+
+
+if __name__ == '__main__':
+  tf.test.main()